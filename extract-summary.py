@@ -6,18 +6,26 @@ Claude Bell - 智能任务摘要提取器
 从 Claude Code transcript 文件中提取任务摘要
 """
 
-import json
+from __future__ import annotations
+
+import os
 import sys
-import re
-from pathlib import Path
-from datetime import datetime
-from collections import Counter
+import zlib
+
+# 只在类型检查时导入：hook 每次触发都是冷启动，运行时尽量少导入模块
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    import re
+    from typing import Any, BinaryIO, Optional
+
+# JSON 解析函数首次使用时才导入（stdlib json 会连带导入 re，约 10ms），见 _json_loads
+_loads: Any = None
 
 
-# 错误关键词
+# 错误关键词（小写，与小写化后的文本匹配）
 ERROR_PATTERNS = [
-    r'API Error',
-    r'Error:',
+    r'api error',
+    r'error:',
     r'403',
     r'401',
     r'500',
@@ -31,7 +39,7 @@ ERROR_PATTERNS = [
     r'permission denied',
 ]
 
-# 需要用户操作的关键词
+# 需要用户操作的关键词（小写）
 ACTION_PATTERNS = [
     r'please run',
     r'请运行',
@@ -40,15 +48,135 @@ ACTION_PATTERNS = [
     r'approve',
 ]
 
+# 跳过的控制命令（小写匹配）
+SKIP_COMMANDS = {
+    'ultrawork', 'continue', 'ok', 'yes', 'no', 'y', 'n',
+    '继续', '好的', '是', '好', '可以', '确认', '嗯', '行',
+    'go', 'next', 'done', 'thanks', '谢谢', '感谢'
+}
+
+# 结束时间只需要最近的消息
+TAIL_SIZE = 20
+
+# 读取文件尾部时每次读取的字节数（不够 TAIL_SIZE 行时按 4 倍扩大）
+TAIL_BLOCK = 64 * 1024
+
+# 全量扫描每次读取的字节数，内存占用与文件大小无关
+SCAN_BLOCK = 4 * 1024 * 1024
+
+# 错误信息只从最后几条消息中提取
+ERROR_WINDOW = 10
+
+# 摘要中保留的修改文件数 / Bash 命令数，收集满后不再处理
+MAX_FILES_MODIFIED = 5
+MAX_BASH_COMMANDS = 3
+
+# 待扫描字节数达到该值时改用 orjson（stdlib json 约 15.6ms/MB，orjson 约 2.8ms/MB）
+ORJSON_MIN_BYTES = 1 << 20
+
+# 增量解析缓存（卸载时随安装目录一起删除）
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.claude-bell', 'cache')
+CACHE_SUFFIX = '.bellcache'
+CACHE_VERSION = 1
+# 超过该时长（秒）未更新、或 transcript 已不存在的缓存在新建缓存时清理
+CACHE_MAX_AGE = 30 * 86400
+# 校验缓存时比对的字节数（文件开头 / 已扫描位置之前）
+FINGERPRINT_BYTES = 4096
+
+# 纯字面量关键词用 Aho-Corasick 一次扫描（可选依赖 pyahocorasick）
+# 只有 需要.*确认 是真正的正则，单独保留
+_ACTION_REGEX = r'需要.*确认'
+
+# 合并为单个交替正则，避免逐个 re.search；首次使用时才编译
+_REGEX_SOURCES = {
+    'error': '|'.join(ERROR_PATTERNS),
+    'action': '|'.join(ACTION_PATTERNS),
+    'error_capture': r'(?i)(API Error[^\n]*|Error:[^\n]*|403[^\n]*|failed[^\n]*)',
+    'action_regex': _ACTION_REGEX,
+}
+_regexes: dict[str, re.Pattern[str]] = {}
+
+# 所有关键词的小写字面量片段，任一关键词命中时至少包含其中之一
+_LITERAL_HINTS = (
+    'error', '403', '401', '500', 'fail', '失败', 'forbidden', 'unauthorized',
+    'timeout', 'refused', '/login', 'denied', 'please run', '请运行', '需要',
+    'waiting', 'approve',
+)
+
+# 尾部原始行的字节级提示词（错误信息一定包含其中之一）；
+# JSON 用 \\u 转义非 ASCII 时无法按字节判断，也保留该行
+_LITERAL_HINT_BYTES = tuple(hint.encode('utf-8') for hint in _LITERAL_HINTS) + (b'\\u',)
+
+# Aho-Corasick 自动机首次使用时才构建
+_ac_automaton = None
+_ac_checked = False
+
+
+def _regex(name: str) -> re.Pattern[str]:
+    """按需编译并缓存 _REGEX_SOURCES 中的正则"""
+    pattern = _regexes.get(name)
+    if pattern is None:
+        import re
+        pattern = _regexes[name] = re.compile(_REGEX_SOURCES[name])
+    return pattern
+
+
+def _aho_corasick() -> Any:
+    """按需构建并缓存 Aho-Corasick 自动机，pyahocorasick 不可用时返回 None"""
+    global _ac_automaton, _ac_checked
+    if not _ac_checked:
+        _ac_checked = True
+        try:
+            import ahocorasick  # type: ignore[import-not-found]
+        except ImportError:
+            return None
+        automaton = ahocorasick.Automaton()
+        for kw in ERROR_PATTERNS:
+            automaton.add_word(kw, 'error')
+        for kw in ACTION_PATTERNS:
+            if kw != _ACTION_REGEX:
+                automaton.add_word(kw, 'action_needed')
+        automaton.make_automaton()
+        _ac_automaton = automaton
+    return _ac_automaton
+
+
+def classify_content(content: str) -> str:
+    """按关键词分类文本：error/action_needed，无匹配返回空字符串"""
+    # 字面量预过滤：绝大多数消息不含任何关键词，直接跳过正则
+    content_lower = content.lower()
+    if not any(hint in content_lower for hint in _LITERAL_HINTS):
+        return ''
 
-def extract_text_from_content(content) -> str:
+    automaton = _aho_corasick()
+    if automaton is None:
+        if _regex('error').search(content_lower):
+            return 'error'
+        if _regex('action').search(content_lower):
+            return 'action_needed'
+        return ''
+
+    # 错误优先于需要操作
+    found = ''
+    for _, tag in automaton.iter(content_lower):
+        if tag == 'error':
+            return 'error'
+        found = tag
+    if found:
+        return found
+    if _regex('action_regex').search(content_lower):
+        return 'action_needed'
+    return ''
+
+
+def extract_text_from_content(content: Any) -> str:
     """从 content 中提取文本（支持字符串和数组格式）"""
     if isinstance(content, str):
         return content
 
     if isinstance(content, list):
-        # content 是数组，提取所有 type="text" 的 text 字段
-        texts = []
+        # content 是数组，只提取 type="text" 的 text 字段（跳过 tool_use、image 等）
+        texts: list[str] = []
         for item in content:
             if isinstance(item, dict):
                 if item.get('type') == 'text':
@@ -60,223 +188,556 @@ def extract_text_from_content(content) -> str:
     return ''
 
 
-def detect_status(messages: list) -> str:
-    """检测任务状态：success/error/action_needed"""
-    # 找到最后一个有内容的用户消息（跳过只有图片的消息）
-    last_meaningful_user_idx = -1
-    for i in range(len(messages) - 1, -1, -1):
-        msg = messages[i]
-        if msg.get('type') == 'user':
-            # 检查是否有文本内容
-            message_obj = msg.get('message', {})
-            if isinstance(message_obj, dict):
-                content = extract_text_from_content(message_obj.get('content', ''))
-                if content and len(content.strip()) > 3:
-                    last_meaningful_user_idx = i
-                    break
+def extract_tool_output(output: Any) -> str:
+    """从 tool_result 的输出中提取文本
 
-    # 从最后一个有意义的用户消息开始检查
-    start_idx = max(0, last_meaningful_user_idx)
-    recent_messages = messages[start_idx:]
+    字符串原样返回；数组只取图片、tool_use 以外各项中字符串类型的 text/content 字段
+    （不对整个结构 str()，避免 base64 图片数据或工具输入中的字符被当成错误关键词）；
+    dict（如 {'stdout': ..., 'stderr': ...}）拼接其中的字符串值；数字等标量退回 str()。
+    """
+    if isinstance(output, str):
+        return output
 
-    for msg in reversed(recent_messages):
-        msg_type = msg.get('type', '')
+    if isinstance(output, list):
+        texts: list[str] = []
+        for item in output:
+            if not isinstance(item, dict) or item.get('type') in ('image', 'tool_use'):
+                continue
+            for key in ('text', 'content'):
+                value = item.get(key)
+                if isinstance(value, str) and value:
+                    texts.append(value)
+        return '\n'.join(texts)
 
-        # 快速检测：isApiErrorMessage 标志
-        if msg.get('isApiErrorMessage'):
-            return 'error'
+    if isinstance(output, dict):
+        return '\n'.join(v for v in output.values() if isinstance(v, str))
 
-        # 快速检测：error 字段
-        if msg.get('error'):
-            return 'error'
+    if not output:
+        return ''
+    return str(output)
 
-        content = ''
 
-        # 获取消息内容（支持多种格式）
-        if msg_type == 'assistant':
-            message_obj = msg.get('message', {})
-            if isinstance(message_obj, dict):
-                content = extract_text_from_content(message_obj.get('content', ''))
-            if not content:
-                content = extract_text_from_content(msg.get('content', ''))
-        elif msg_type == 'tool_result':
-            content = str(msg.get('tool_output', '') or msg.get('content', ''))
-        elif msg_type == 'user':
-            message_obj = msg.get('message', {})
-            if isinstance(message_obj, dict):
-                content = extract_text_from_content(message_obj.get('content', ''))
-            if not content:
-                content = extract_text_from_content(msg.get('content', ''))
+def _is_meaningful_user(msg: dict[str, Any]) -> bool:
+    """是否为有文本内容的用户消息（跳过只有图片的消息），这类消息开始新一轮任务"""
+    message_obj = msg.get('message', {})
+    if isinstance(message_obj, dict):
+        content = extract_text_from_content(message_obj.get('content', ''))
+        if content and len(content.strip()) > 3:
+            return True
+    return False
+
+
+def detect_message_status(msg: dict[str, Any]) -> str:
+    """检测单条消息的状态：error/action_needed，没有信号时返回空字符串"""
+    msg_type = msg.get('type', '')
+
+    # 快速检测：isApiErrorMessage 标志
+    if msg.get('isApiErrorMessage'):
+        return 'error'
+
+    # 快速检测：error 字段
+    if msg.get('error'):
+        return 'error'
 
+    content = ''
+
+    # 获取消息内容（支持多种格式）
+    if msg_type == 'assistant':
+        message_obj = msg.get('message', {})
+        if isinstance(message_obj, dict):
+            content = extract_text_from_content(message_obj.get('content', ''))
         if not content:
-            continue
+            content = extract_text_from_content(msg.get('content', ''))
+    elif msg_type == 'tool_result':
+        content = extract_tool_output(msg.get('tool_output', '') or msg.get('content', ''))
+    elif msg_type == 'user':
+        message_obj = msg.get('message', {})
+        if isinstance(message_obj, dict):
+            content = extract_text_from_content(message_obj.get('content', ''))
+        if not content:
+            content = extract_text_from_content(msg.get('content', ''))
 
-        # 检查错误
-        for pattern in ERROR_PATTERNS:
-            if re.search(pattern, content, re.IGNORECASE):
-                return 'error'
+    if not content:
+        return ''
 
-        # 检查需要操作
-        for pattern in ACTION_PATTERNS:
-            if re.search(pattern, content, re.IGNORECASE):
-                return 'action_needed'
+    # 检查错误 / 需要操作
+    return classify_content(content)
 
-    return 'success'
 
+def _may_affect_status(raw_line: bytes) -> bool:
+    """不解析 JSON，判断尾部的一行是否可能含错误信息
 
-def parse_transcript(transcript_path: str) -> dict:
-    """解析 transcript JSONL 文件"""
-    messages = []
-    tools_used = Counter()
-    files_modified = set()
-    bash_commands = []
+    不含任何提示词的行（如普通的 tool_result 输出）提取不到错误信息，直接跳过即可。
+    """
+    raw_lower = raw_line.lower()
+    return any(hint in raw_lower for hint in _LITERAL_HINT_BYTES)
 
-    try:
-        with open(transcript_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    msg = json.loads(line)
-                    messages.append(msg)
-
-                    msg_type = msg.get('type', '')
-
-                    # 统计工具使用
-                    if msg_type == 'tool_use':
-                        tool_name = msg.get('tool_name', 'unknown')
-                        tools_used[tool_name] += 1
-
-                        tool_input = msg.get('tool_input', {})
-                        if isinstance(tool_input, dict):
-                            # 提取修改的文件
-                            file_path = tool_input.get('file_path') or tool_input.get('path')
-                            if file_path and tool_name in ('Edit', 'Write'):
-                                files_modified.add(Path(file_path).name)
-
-                            # 提取 Bash 命令
-                            if tool_name == 'Bash':
-                                cmd = tool_input.get('command', '')
-                                if cmd:
-                                    bash_commands.append(cmd[:50])
-
-                except json.JSONDecodeError:
-                    continue
-    except Exception as e:
-        return {'error': str(e)}
 
+def _tail_lines(f: BinaryIO, size: int, n: int = TAIL_SIZE) -> list[bytes]:
+    """读取文件前 size 字节的末尾，返回最后 n 个非空行（bytes）"""
+    block = TAIL_BLOCK
+    while True:
+        start = max(0, size - block)
+        f.seek(start)
+        parts = f.read(size - start).split(b'\n')
+        if start > 0:
+            # 从文件中间开始读时第一段可能是不完整的行
+            parts = parts[1:]
+        lines = [line for line in parts if line.strip()]
+        if len(lines) >= n or start == 0:
+            return lines[-n:]
+        block *= 4
+
+
+def _new_scan_state() -> dict[str, Any]:
+    """全量扫描的初始状态"""
     return {
-        'messages': messages,
-        'tools_used': dict(tools_used),
-        'files_modified': list(files_modified)[:5],
-        'bash_commands': bash_commands[:3],
-        'total_messages': len(messages),
-        'status': detect_status(messages)
+        'offset': 0,
+        'tools_used': {},
+        'files_modified': [],
+        'bash_commands': [],
+        'last_user_ts': None,
+        'turn_status': '',
+        'query': '',
     }
 
 
-def extract_user_query(messages: list) -> str:
-    """提取最后一个有意义的用户需求"""
-    # 跳过的控制命令（小写匹配）
-    skip_commands = {
-        'ultrawork', 'continue', 'ok', 'yes', 'no', 'y', 'n',
-        '继续', '好的', '是', '好', '可以', '确认', '嗯', '行',
-        'go', 'next', 'done', 'thanks', '谢谢', '感谢'
+def _cache_path(transcript_path: str) -> str:
+    """transcript 对应的缓存文件路径（文件名 + 完整路径的 CRC，避免重名）"""
+    path = os.path.abspath(transcript_path)
+    crc = zlib.crc32(path.encode('utf-8', 'surrogateescape'))
+    return os.path.join(CACHE_DIR, f'{os.path.basename(path)}.{crc:08x}{CACHE_SUFFIX}')
+
+
+def _fingerprint(f: BinaryIO, offset: int) -> list[int]:
+    """已扫描部分的指纹：开头和 offset 之前各 FINGERPRINT_BYTES 字节的 CRC"""
+    f.seek(0)
+    head = f.read(min(offset, FINGERPRINT_BYTES))
+    start = max(0, offset - FINGERPRINT_BYTES)
+    f.seek(start)
+    return [zlib.crc32(head), zlib.crc32(f.read(offset - start))]
+
+
+def _load_cache(cache_path: str, st: os.stat_result, f: BinaryIO) -> Optional[dict[str, Any]]:
+    """读取上次的扫描状态
+
+    缓存损坏、文件被截断或替换（inode / 已扫描部分的指纹不一致）时返回 None，
+    此时需要从头重新扫描。
+    """
+    try:
+        with open(cache_path, 'rb') as cf:
+            cache = _json_loads()(cf.read())
+        state = _new_scan_state()
+        state.update(cache['state'])
+        offset = state['offset']
+        if (cache.get('version') != CACHE_VERSION or cache['ino'] != st.st_ino
+                or offset > st.st_size or cache['fingerprint'] != _fingerprint(f, offset)):
+            return None
+        return state
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+def _save_cache(cache_path: str, transcript_path: str, state: dict[str, Any],
+                st: os.stat_result, f: BinaryIO) -> None:
+    """保存扫描状态（先写临时文件再原子替换），写入失败时忽略
+
+    新建缓存文件时顺带清理过期的缓存（见 _prune_cache）。
+    """
+    import json
+
+    cache = {
+        'version': CACHE_VERSION,
+        'path': os.path.abspath(transcript_path),
+        'ino': st.st_ino,
+        'fingerprint': _fingerprint(f, state['offset']),
+        'state': state,
     }
+    # 不用 tempfile（导入约 5ms）：按 pid 命名的临时文件，O_EXCL 保证是新建的
+    tmp_path = os.path.join(CACHE_DIR, f'.tmp-{os.getpid()}')
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        try:
+            fd = os.open(tmp_path, flags, 0o600)
+        except FileExistsError:
+            # 之前同 pid 的进程异常退出时残留的临时文件
+            os.unlink(tmp_path)
+            fd = os.open(tmp_path, flags, 0o600)
+    except OSError:
+        return
+    is_new = not os.path.exists(cache_path)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as out:
+            json.dump(cache, out, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except (OSError, ValueError):
+        # ValueError：文本含孤立代理字符等无法编码为 UTF-8 的内容
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        return
+    if is_new:
+        _prune_cache(cache_path)
 
-    # 从后往前找最后一个有意义的用户消息
-    for msg in reversed(messages):
-        if msg.get('type') == 'user':
-            # 尝试从 message.content 提取（新格式）
-            message_obj = msg.get('message', {})
-            if isinstance(message_obj, dict):
-                content = extract_text_from_content(message_obj.get('content', ''))
-            else:
-                content = ''
 
-            # 如果没找到，尝试直接从 content 提取（旧格式）
-            if not content:
-                content = extract_text_from_content(msg.get('content', ''))
+def _prune_cache(keep: str) -> None:
+    """删除 CACHE_MAX_AGE 内未更新或 transcript 已不存在的缓存（含残留的临时文件），失败时忽略
 
-            if not content:
-                continue
+    每个 transcript 一个缓存文件，不清理会一直累积；只在新建缓存时（即新会话）运行。
+    """
+    import time
 
-            content_stripped = content.strip()
-            content_lower = content_stripped.lower()
+    cutoff = time.time() - CACHE_MAX_AGE
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(CACHE_DIR, name)
+        if path == keep:
+            continue
+        try:
+            if os.stat(path).st_mtime >= cutoff:
+                if not name.endswith(CACHE_SUFFIX):
+                    continue
+                with open(path, 'rb') as f:
+                    transcript_path = _json_loads()(f.read()).get('path')
+                if transcript_path and os.path.exists(transcript_path):
+                    continue
+            os.unlink(path)
+        except (OSError, ValueError, AttributeError):
+            continue
 
-            # 跳过控制命令
-            if content_lower in skip_commands:
-                continue
 
-            # 跳过太短的内容
-            if len(content_stripped) < 5:
-                continue
+def _handle_edit(tool_input: dict[str, Any], state: dict[str, Any]) -> None:
+    """Edit/Write：记录修改的文件名（去重，收集满即停止）"""
+    files_modified = state['files_modified']
+    if len(files_modified) >= MAX_FILES_MODIFIED or not isinstance(tool_input, dict):
+        return
+    file_path = tool_input.get('file_path') or tool_input.get('path')
+    if file_path:
+        name = file_path.rsplit('/', 1)[-1].rsplit('\\', 1)[-1]
+        if name not in files_modified:
+            files_modified.append(name)
+
+
+def _handle_bash(tool_input: dict[str, Any], state: dict[str, Any]) -> None:
+    """Bash：记录执行的命令（收集满即停止）"""
+    bash_commands = state['bash_commands']
+    if len(bash_commands) >= MAX_BASH_COMMANDS or not isinstance(tool_input, dict):
+        return
+    cmd = tool_input.get('command', '')
+    if cmd:
+        bash_commands.append(cmd[:50])
+
+
+# 需要读取 tool_input 的工具
+_TOOL_HANDLERS = {
+    'Edit': _handle_edit,
+    'Write': _handle_edit,
+    'Bash': _handle_bash,
+}
+
+
+def _json_loads() -> Any:
+    """按需导入并缓存 JSON 解析函数
+
+    默认使用导入开销小的 ujson（可选依赖），不可用时用 stdlib json；orjson 解析更快
+    但导入约 18ms，只在待扫描数据较多时才用（见 _bulk_loads）。
+    """
+    global _loads
+    if _loads is None:
+        try:
+            from ujson import loads  # type: ignore[import-not-found, import-untyped, unused-ignore]
+        except ImportError:
+            from json import loads
+        _loads = loads
+    return _loads
 
-            # 跳过只有符号的内容
-            if content_stripped in ['...', '。。。', '???', '！！！']:
+
+def _bulk_loads(pending: int) -> Any:
+    """全量扫描用的 JSON 解析函数：待扫描数据足够多时才导入 orjson"""
+    if pending >= ORJSON_MIN_BYTES:
+        try:
+            from orjson import loads  # type: ignore[import-not-found, unused-ignore]
+            return loads
+        except ImportError:
+            pass
+    return _json_loads()
+
+
+def _scan_file(f: BinaryIO, state: dict[str, Any], size: int) -> None:
+    """从 state['offset'] 扫描到 size，按 SCAN_BLOCK 分块读取
+
+    每块在最后一个换行处切开，剩余的半行并入下一块；最后一块交给 _scan_lines
+    处理可能不完整的末行。
+    """
+    loads = _bulk_loads(size - state['offset'])
+    f.seek(state['offset'])
+    remaining = size - state['offset']
+    rest = b''
+    while remaining > 0:
+        block = f.read(min(SCAN_BLOCK, remaining))
+        if not block:
+            # 读取期间文件被截断
+            break
+        remaining -= len(block)
+        data = rest + block
+        if remaining > 0:
+            cut = data.rfind(b'\n') + 1
+            data, rest = data[:cut], data[cut:]
+            if not data:
                 continue
+        _scan_lines(data, state, loads)
+
+
+def _scan_lines(data: bytes, state: dict[str, Any], loads: Any) -> None:
+    """扫描从 state['offset'] 开始读到的 data，把统计结果累加到 state"""
+    # 热循环中用到的全局名/方法绑定为局部变量
+    find = data.find
+    tools_used = state['tools_used']
+    tools_get = tools_used.get
+    handlers_get = _TOOL_HANDLERS.get
+    turn_start: Optional[int] = None
+    pos = 0
+    size = len(data)
+
+    while pos < size:
+        start = pos
+        end = find(b'\n', start)
+        if end < 0:
+            # 末行可能还在写入中：不完整时不前移偏移量，下次重新读取
+            end = size
+            try:
+                loads(data[start:end])
+            except (ValueError, TypeError):
+                break
+            pos = size
+        else:
+            pos = end + 1
+
+        # 逐行字节预过滤比直接解析更慢，每行都直接解析
+        try:
+            msg = loads(data[start:end])
+        except (ValueError, TypeError):
+            continue
 
-            # 提取第一行作为摘要（通常是主要任务）
-            first_line = content_stripped.split('\n')[0].strip()
-            if len(first_line) > 5:
-                return first_line[:80] + ('...' if len(first_line) > 80 else '')
+        msg_type = msg.get('type', '')
 
-            # 如果第一行太短，用完整内容
-            return content_stripped[:80] + ('...' if len(content_stripped) > 80 else '')
+        # 记录最后一个用户消息及有意义的需求；有意义的用户消息开始新一轮
+        if msg_type == 'user':
+            state['last_user_ts'] = msg.get('timestamp', '')
+            state['query'] = extract_user_query(msg) or state['query']
+            if _is_meaningful_user(msg):
+                turn_start = start
+            continue
 
+        if msg_type != 'tool_use':
+            continue
+
+        # 统计工具使用
+        tool_name = msg.get('tool_name', 'unknown')
+        tools_used[tool_name] = tools_get(tool_name, 0) + 1
+
+        # 按工具名分派（Edit/Write 记录文件，Bash 记录命令）
+        handler = handlers_get(tool_name)
+        if handler is not None:
+            handler(msg.get('tool_input') or {}, state)
+
+    # 当前轮次的状态：新读到的部分没有信号时，沿用之前扫描的结果（仍在同一轮时）
+    status = _latest_status(data, 0 if turn_start is None else turn_start, pos)
+    if status or turn_start is not None:
+        state['turn_status'] = status
+    state['offset'] += pos
+
+
+def _latest_status(data: bytes, start: int, end: int) -> str:
+    """从 data[start:end] 的最后一行往前检测状态，返回最新的信号，没有信号时返回空字符串
+
+    越新的信号优先，找到即停止，通常只需解析最后几行。
+    """
+    loads = _json_loads()
+    while end > start:
+        line_start = data.rfind(b'\n', start, end - 1) + 1 or start
+        line = data[line_start:end]
+        end = line_start
+        if not line.strip():
+            continue
+        try:
+            status = detect_message_status(loads(line))
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if status:
+            return status
     return ''
 
 
-def calculate_duration(messages: list) -> str:
-    """计算最近一轮任务的时长"""
-    if len(messages) < 2:
-        return ''
+def parse_transcript(transcript_path: str) -> dict[str, Any]:
+    """解析 transcript JSONL 文件
 
+    全量扫描逐行解析并累计统计，当前轮次的状态从末尾往前检测；错误信息只从文件尾部提取。
+    全量扫描的结果缓存在 CACHE_DIR 中，下次只解析新追加的部分。
+    """
     try:
-        # 找到最后一个用户消息的位置
-        last_user_idx = -1
-        for i in range(len(messages) - 1, -1, -1):
-            if messages[i].get('type') == 'user':
-                last_user_idx = i
+        state = _new_scan_state()
+
+        # 只分块读取新追加的部分和文件尾部（不用 mmap：映射期间文件被截断会触发 SIGBUS），
+        # 原始 bytes 直接交给解析器
+        tail_lines: list[bytes] = []
+        with open(transcript_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size:
+                cache_path = _cache_path(transcript_path)
+                cached = _load_cache(cache_path, st, f)
+                if cached is not None:
+                    state = cached
+                if state['offset'] != st.st_size:
+                    _scan_file(f, state, st.st_size)
+                    _save_cache(cache_path, transcript_path, state, st, f)
+                tail_lines = _tail_lines(f, st.st_size)
+
+        # 尾部消息：错误信息提取（先按条数截取，只解析其中可能相关的行）
+        loads = _json_loads()
+        tail: list[dict[str, Any]] = []
+        for line in tail_lines[-ERROR_WINDOW:]:
+            if not _may_affect_status(line):
+                continue
+            try:
+                tail.append(loads(line))
+            except (ValueError, TypeError):
+                continue
+
+        # 结束时间：从最后一行往前找第一个时间戳
+        last_ts: Optional[str] = None
+        for line in reversed(tail_lines):
+            try:
+                last_ts = loads(line).get('timestamp')
+            except (ValueError, TypeError, AttributeError):
+                continue
+            if last_ts:
                 break
+    except Exception as e:
+        return {'error': str(e)}
+
+    return {
+        'tail': tail,
+        'tools_used': state['tools_used'],
+        'files_modified': state['files_modified'],
+        'bash_commands': state['bash_commands'],
+        'last_ts': last_ts,
+        'last_user_ts': state['last_user_ts'],
+        'query': state['query'],
+        'status': state['turn_status'] or 'success'
+    }
+
 
-        if last_user_idx < 0:
-            return ''
+def extract_user_query(msg: dict[str, Any]) -> str:
+    """从用户消息中提取有意义的需求，控制命令等返回空字符串"""
+    # 尝试从 message.content 提取（新格式）
+    message_obj = msg.get('message', {})
+    if isinstance(message_obj, dict):
+        content = extract_text_from_content(message_obj.get('content', ''))
+    else:
+        content = ''
 
-        # 计算从最后一个用户消息到最后一条消息的时长
-        first_ts = messages[last_user_idx].get('timestamp', '')
-        last_ts = messages[-1].get('timestamp', '')
+    # 如果没找到，尝试直接从 content 提取（旧格式）
+    if not content:
+        content = extract_text_from_content(msg.get('content', ''))
 
-        if first_ts and last_ts:
-            # 解析 ISO 格式时间
-            start = datetime.fromisoformat(first_ts.replace('Z', '+00:00'))
-            end = datetime.fromisoformat(last_ts.replace('Z', '+00:00'))
-            duration = end - start
+    if not content:
+        return ''
 
-            total_seconds = int(duration.total_seconds())
-            if total_seconds < 0 or total_seconds > 3600:  # 超过1小时可能是数据问题
-                return ''
+    content_stripped = content.strip()
+    content_lower = content_stripped.lower()
 
-            if total_seconds < 5:  # 太短不显示
-                return ''
+    # 跳过控制命令
+    if content_lower in SKIP_COMMANDS:
+        return ''
 
-            minutes = total_seconds // 60
-            seconds = total_seconds % 60
+    # 跳过太短的内容
+    if len(content_stripped) < 5:
+        return ''
 
-            if minutes > 0:
-                return f'{minutes}分{seconds}秒'
-            else:
-                return f'{seconds}秒'
-    except Exception:
+    # 跳过只有符号的内容
+    if content_stripped in ['...', '。。。', '???', '！！！']:
+        return ''
+
+    # 提取第一行作为摘要（通常是主要任务）
+    first_line = content_stripped.split('\n')[0].strip()
+    if len(first_line) > 5:
+        return first_line[:80] + ('...' if len(first_line) > 80 else '')
+
+    # 如果第一行太短，用完整内容
+    return content_stripped[:80] + ('...' if len(content_stripped) > 80 else '')
+
+
+def _days_from_civil(year: int, month: int, day: int) -> int:
+    """公历日期距 1970-01-01 的天数（等价于 calendar.timegm，但不导入 calendar/datetime）"""
+    year -= month <= 2
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def _iso_to_epoch(ts: str) -> float:
+    """解析 transcript 的 UTC 时间戳（如 2024-01-02T03:04:05.678Z）为 epoch 秒
+
+    只处理固定格式，其他格式抛出 ValueError
+    """
+    if len(ts) < 20 or ts[-1] != 'Z' or ts[10] != 'T' or (len(ts) > 20 and ts[19] != '.'):
+        raise ValueError(ts)
+    frac = float(ts[19:-1]) if len(ts) > 20 else 0.0
+    days = _days_from_civil(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]))
+    return days * 86400 + int(ts[11:13]) * 3600 + int(ts[14:16]) * 60 + int(ts[17:19]) + frac
+
+
+def _iso_delta(start_ts: str, end_ts: str) -> float:
+    """两个 ISO 格式时间戳之间的秒数"""
+    try:
+        return _iso_to_epoch(end_ts) - _iso_to_epoch(start_ts)
+    except ValueError:
         pass
 
-    return ''
+    # 非标准格式（如带时区偏移）交给 fromisoformat
+    from datetime import datetime
+
+    start = datetime.fromisoformat(start_ts.replace('Z', '+00:00'))
+    end = datetime.fromisoformat(end_ts.replace('Z', '+00:00'))
+    return (end - start).total_seconds()
+
+
+def calculate_duration(start_ts: str, end_ts: str) -> str:
+    """计算最近一轮任务的时长（最后一个用户消息到最后一条消息）"""
+    if not start_ts or not end_ts:
+        return ''
+
+    try:
+        total_seconds = int(_iso_delta(start_ts, end_ts))
+    except Exception:
+        return ''
+
+    if total_seconds < 0 or total_seconds > 3600:  # 超过1小时可能是数据问题
+        return ''
+
+    if total_seconds < 5:  # 太短不显示
+        return ''
+
+    minutes = total_seconds // 60
+    seconds = total_seconds % 60
+
+    if minutes > 0:
+        return f'{minutes}分{seconds}秒'
+    else:
+        return f'{seconds}秒'
 
 
-def get_error_message(messages: list) -> str:
+def get_error_message(messages: list[dict[str, Any]]) -> str:
     """提取错误信息"""
-    recent_messages = messages[-10:] if len(messages) > 10 else messages
+    recent_messages = messages[-ERROR_WINDOW:]
 
     for msg in reversed(recent_messages):
         content = ''
@@ -289,36 +750,36 @@ def get_error_message(messages: list) -> str:
             if not content:
                 content = extract_text_from_content(msg.get('content', ''))
         elif msg_type == 'tool_result':
-            content = str(msg.get('tool_output', '') or msg.get('content', ''))
+            content = extract_tool_output(msg.get('tool_output', '') or msg.get('content', ''))
 
         if not content:
             continue
 
         # 查找 API Error 等错误信息
-        match = re.search(r'(API Error[^\n]*|Error:[^\n]*|403[^\n]*|failed[^\n]*)', content, re.IGNORECASE)
+        match = _regex('error_capture').search(content)
         if match:
             return match.group(1)[:80]
 
     return ''
 
 
-def generate_summary(transcript_path: str) -> dict:
+def generate_summary(transcript_path: str) -> dict[str, str]:
     """生成任务摘要，返回 {status, summary}"""
     data = parse_transcript(transcript_path)
 
     if 'error' in data:
         return {'status': 'success', 'summary': '任务完成'}
 
-    messages = data['messages']
+    tail = data['tail']
     tools = data['tools_used']
     status = data.get('status', 'success')
 
-    # 提取用户查询
-    query = extract_user_query(messages)
+    # 用户查询
+    query = data['query']
 
     # 如果是错误状态，提取错误信息
     if status == 'error':
-        error_msg = get_error_message(messages)
+        error_msg = get_error_message(tail)
         short_query = query[:60] + ('...' if len(query) > 60 else '') if query else ''
         return {
             'status': 'error',
@@ -335,7 +796,7 @@ def generate_summary(transcript_path: str) -> dict:
         }
 
     # 生成工具统计
-    stats_parts = []
+    stats_parts: list[str] = []
 
     edit_count = tools.get('Edit', 0) + tools.get('Write', 0)
     if edit_count > 0:
@@ -350,7 +811,7 @@ def generate_summary(transcript_path: str) -> dict:
         stats_parts.append(f"读{read_count}文件")
 
     # 计算时长
-    duration = calculate_duration(messages)
+    duration = calculate_duration(data['last_user_ts'], data['last_ts'])
 
     # 构建统计信息
     if duration:
@@ -368,12 +829,12 @@ def generate_summary(transcript_path: str) -> dict:
     }
 
 
-def main():
+def main() -> None:
     """主函数"""
     if len(sys.argv) < 2:
         # 从 stdin 读取（hook 模式）
         try:
-            hook_input = json.loads(sys.stdin.read())
+            hook_input = _json_loads()(sys.stdin.buffer.read())
             transcript_path = hook_input.get('transcript_path', '')
         except Exception:
             transcript_path = ''
@@ -381,12 +842,13 @@ def main():
         # 命令行参数模式
         transcript_path = sys.argv[1]
 
-    if transcript_path and Path(transcript_path).exists():
+    if transcript_path and os.path.exists(transcript_path):
         result = generate_summary(transcript_path)
-        # 输出格式: status|query|stats
-        print(f"{result['status']}|{result['query']}|{result.get('stats', '')}")
+        # 输出格式: status|query|stats（直接写 UTF-8 字节，进程退出时自动 flush）
+        out = result['status'] + '|' + result['query'] + '|' + (result.get('stats') or '')
+        sys.stdout.buffer.write(out.encode('utf-8', 'replace') + b'\n')
     else:
-        print('success|任务完成|')
+        sys.stdout.buffer.write('success|任务完成|\n'.encode('utf-8'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""extract-summary.py 的测试（python -m unittest）"""
+
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+_spec = importlib.util.spec_from_file_location(
+    'extract_summary', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extract-summary.py'))
+extract_summary = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(extract_summary)
+
+
+def _line(msg):
+    return (json.dumps(msg, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def _user(text, ts='2026-01-01T00:00:00Z'):
+    return _line({'type': 'user', 'timestamp': ts, 'message': {'role': 'user', 'content': text}})
+
+
+def _assistant(text, ts='2026-01-01T00:00:30Z'):
+    return _line({'type': 'assistant', 'timestamp': ts,
+                  'message': {'role': 'assistant', 'content': [{'type': 'text', 'text': text}]}})
+
+
+def _tool_use(name, tool_input):
+    return _line({'type': 'tool_use', 'tool_name': name, 'tool_input': tool_input})
+
+
+class ScanCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'session.jsonl')
+
+        cache_dir = extract_summary.CACHE_DIR
+        extract_summary.CACHE_DIR = os.path.join(self.tmp, 'cache')
+        self.addCleanup(setattr, extract_summary, 'CACHE_DIR', cache_dir)
+
+        # 记录每次扫描的起始偏移量和读入的字节数
+        self.scans = []
+        scan_lines = extract_summary._scan_lines
+
+        def spy(data, state, *args):
+            self.scans.append((state['offset'], len(data)))
+            return scan_lines(data, state, *args)
+
+        extract_summary._scan_lines = spy
+        self.addCleanup(setattr, extract_summary, '_scan_lines', scan_lines)
+
+    def write(self, data, mode='wb'):
+        with open(self.path, mode) as f:
+            f.write(data)
+
+    def parse(self):
+        self.scans.clear()
+        return extract_summary.parse_transcript(self.path)
+
+    def parse_cold(self):
+        shutil.rmtree(extract_summary.CACHE_DIR, ignore_errors=True)
+        return self.parse()
+
+    def test_warm_cache_hit(self):
+        self.write(_user('build the parser') + _tool_use('Edit', {'file_path': '/src/a.py'})
+                   + _assistant('all done'))
+        first = self.parse()
+        self.assertEqual(self.scans, [(0, os.path.getsize(self.path))])
+
+        second = self.parse()
+        self.assertEqual(self.scans, [])
+        self.assertEqual(second, first)
+        self.assertEqual(second['files_modified'], ['a.py'])
+
+    def test_append_after_cache_hit(self):
+        head = _user('build the parser') + _tool_use('Bash', {'command': 'make'})
+        self.write(head)
+        self.parse()
+        self.parse()
+
+        tail = _tool_use('Bash', {'command': 'make test'}) + _assistant('Error: tests failed')
+        self.write(tail, 'ab')
+        result = self.parse()
+        self.assertEqual(self.scans, [(len(head), len(tail))])
+        self.assertEqual(result['bash_commands'], ['make', 'make test'])
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(result, self.parse_cold())
+
+    def test_error_in_earlier_scan_kept_for_same_turn(self):
+        self.write(_user('build the parser') + _assistant('Error: boom'))
+        self.parse()
+        self.write(_assistant('still working'), 'ab')
+        self.assertEqual(self.parse()['status'], 'error')
+
+        self.write(_user('now something else'), 'ab')
+        self.assertEqual(self.parse()['status'], 'success')
+
+    def test_truncated_transcript_rescans(self):
+        self.write(_user('build the parser') + _tool_use('Edit', {'file_path': '/src/a.py'})
+                   + _assistant('Error: boom'))
+        self.parse()
+
+        data = _user('write the docs')
+        self.write(data)
+        result = self.parse()
+        self.assertEqual(self.scans, [(0, len(data))])
+        self.assertEqual(result['query'], 'write the docs')
+        self.assertEqual(result['files_modified'], [])
+        self.assertEqual(result['status'], 'success')
+
+    def test_replaced_transcript_rescans(self):
+        data = _user('build the parser') + _tool_use('Edit', {'file_path': '/src/a.py'})
+        self.write(data)
+        self.parse()
+
+        # 内容相同但长度更长的新文件（inode 不同）必须从头扫描
+        replacement = os.path.join(self.tmp, 'new.jsonl')
+        with open(replacement, 'wb') as f:
+            f.write(data + _tool_use('Edit', {'file_path': '/src/b.py'}))
+        keep_inode = open(self.path, 'rb')  # 防止文件系统复用旧 inode
+        self.addCleanup(keep_inode.close)
+        os.replace(replacement, self.path)
+
+        result = self.parse()
+        self.assertEqual(self.scans[0][0], 0)
+        self.assertEqual(result['files_modified'], ['a.py', 'b.py'])
+
+    def test_same_size_rewrite_rescans(self):
+        self.write(_user('build the parser'))
+        self.parse()
+        self.write(_user('write the tests'))
+        self.assertEqual(self.parse()['query'], 'write the tests')
+        self.assertEqual(self.scans[0][0], 0)
+
+    def test_unterminated_last_line(self):
+        head = _user('build the parser')
+        partial = _tool_use('Bash', {'command': 'make'}).rstrip(b'\n')
+        self.write(head + partial[:20])
+        result = self.parse()
+        self.assertEqual(result['bash_commands'], [])
+
+        # 不完整的末行不计入偏移量，写完后从它的开头重新读取
+        self.write(partial[20:] + b'\n', 'ab')
+        result = self.parse()
+        self.assertEqual(self.scans, [(len(head), len(partial) + 1)])
+        self.assertEqual(result['bash_commands'], ['make'])
+        self.assertEqual(result, self.parse_cold())
+
+    def test_complete_last_line_without_newline(self):
+        head = _user('build the parser')
+        last = _tool_use('Bash', {'command': 'make'}).rstrip(b'\n')
+        self.write(head + last)
+        self.assertEqual(self.parse()['bash_commands'], ['make'])
+
+        self.write(b'\n' + _tool_use('Bash', {'command': 'make test'}), 'ab')
+        result = self.parse()
+        self.assertEqual(self.scans[0][0], len(head) + len(last))
+        self.assertEqual(result['bash_commands'], ['make', 'make test'])
+
+    def test_small_scan_blocks_match_single_block(self):
+        self.write(_user('build the parser') + _tool_use('Edit', {'file_path': '/src/a.py'})
+                   + _tool_use('Bash', {'command': 'make'}) + _assistant('Error: boom')
+                   + _tool_use('Bash', {'command': 'make test'}).rstrip(b'\n'))
+        expected = self.parse_cold()
+
+        # 块比单行还小时，半行跨多个块并入下一块
+        for block in (7, 64, 100):
+            scan_block = extract_summary.SCAN_BLOCK
+            extract_summary.SCAN_BLOCK = block
+            try:
+                self.assertEqual(self.parse_cold(), expected)
+            finally:
+                extract_summary.SCAN_BLOCK = scan_block
+        self.assertEqual(expected['bash_commands'], ['make', 'make test'])
+
+    def test_stale_temp_file_does_not_block_save(self):
+        os.makedirs(extract_summary.CACHE_DIR)
+        stale = os.path.join(extract_summary.CACHE_DIR, '.tmp-%d' % os.getpid())
+        with open(stale, 'w') as f:
+            f.write('partial')
+        self.write(_user('build the parser'))
+        self.parse()
+        self.assertFalse(os.path.exists(stale))
+        self.parse()
+        self.assertEqual(self.scans, [])
+
+
+class DetectStatusTest(unittest.TestCase):
+
+    def test_error_at_end_of_long_output(self):
+        msg = {'type': 'tool_result', 'tool_output': 'x' * 5000 + '\nError: late'}
+        self.assertEqual(extract_summary.detect_message_status(msg), 'error')
+        self.assertEqual(extract_summary.get_error_message([msg]), 'Error: late')
+
+    def test_image_and_tool_use_payloads_not_scanned(self):
+        for item in ({'type': 'image', 'source': {'data': 'iVBOR' + '500' * 10}},
+                     {'type': 'tool_use', 'input': {'command': 'grep "Error:"'}}):
+            msg = {'type': 'tool_result', 'tool_output': [item]}
+            self.assertEqual(extract_summary.detect_message_status(msg), '')
+
+
+if __name__ == '__main__':
+    unittest.main()